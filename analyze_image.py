@@ -1,5 +1,9 @@
 import os
+import re
+import shutil
 import sys
+import tempfile
+import time
 from PIL import Image
 import numpy as np
 import cv2
@@ -9,42 +13,377 @@ from scipy import ndimage
 import logging
 import traceback
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+from transformers.modeling_outputs import BaseModelOutput
 import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+
+try:
+    import cupy as cp
+    import kvikio
+except ImportError:
+    cp = None
+    kvikio = None
+
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForVision2Seq
+except ImportError:
+    onnxruntime = None
+    ORTModelForVision2Seq = None
 
 logger = logging.getLogger(__name__)
 
+TROCR_MODEL_NAME = 'microsoft/trocr-base-handwritten'
+# Exported ONNX models are kept here so the export only runs once
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'trocr-onnx')
+
+# Input resolution expected by the TrOCR ViT encoder
+TROCR_IMAGE_SIZE = (384, 384)
+
+SUPPORTED_FORMATS = ['.dcm', '.jpg', '.jpeg', '.png', '.tiff']
+
+def read_image(image_path):
+    """Load medical image from various formats including DICOM on the CPU"""
+    ext = os.path.splitext(image_path)[1].lower()
+    if ext not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported file format: {ext}")
+    
+    if ext == '.dcm':
+        return Image.fromarray(pydicom.dcmread(image_path).pixel_array)
+    return Image.open(image_path)
+
+def resize_for_trocr(image):
+    """Convert to RGB and downscale to the TrOCR input size while still uint8"""
+    # Convert to RGB if needed
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    # Resizing in PIL avoids the processor building a float tensor of the full scan
+    if image.size != TROCR_IMAGE_SIZE:
+        image = image.resize(TROCR_IMAGE_SIZE, Image.Resampling.BILINEAR)
+    
+    return image
+
+class ReportImageDataset(Dataset):
+    """Loads and preprocesses report images, so DataLoader workers can do it in parallel
+    
+    Each item is (index, prepared image, pixel values, error). A file that fails
+    to load is returned with its error instead of stopping the whole loader.
+    """
+    
+    def __init__(self, image_paths, processor):
+        self.image_paths = image_paths
+        self.processor = processor
+    
+    def __len__(self):
+        return len(self.image_paths)
+    
+    def __getitem__(self, index):
+        try:
+            image = resize_for_trocr(read_image(self.image_paths[index]))
+            pixel_values = self.processor(image, return_tensors="pt", do_resize=False).pixel_values[0]
+            return index, image, pixel_values, None
+        except Exception as e:
+            return index, None, None, e
+
+def collate_reports(samples):
+    """Stack loaded samples into one batch, keeping load errors by index"""
+    loaded = [sample for sample in samples if sample[3] is None]
+    errors = {index: error for index, _, _, error in samples if error is not None}
+    indices = [index for index, _, _, _ in loaded]
+    images = [image for _, image, _, _ in loaded]
+    pixel_values = torch.stack([values for _, _, values, _ in loaded]) if loaded else None
+    return indices, images, pixel_values, errors
+
+class EarlyExitVisionEncoderDecoderModel(VisionEncoderDecoderModel):
+    """VisionEncoderDecoderModel that skips decoder work for finished sequences
+    
+    During batched generation, rows whose last token is eos or pad are left out
+    of the decoder call. Their logits are filled so only pad can be picked next,
+    which keeps generate's stopping criteria working. Only the self-attention
+    cache is sliced and scattered every step. The active rows of the
+    cross-attention cache and encoder states are gathered again only when the
+    set of active rows changes. Both tuple caches and EncoderDecoderCache
+    objects are handled.
+    """
+    # Set to False to decode with the stock forward, e.g. to compare outputs
+    early_exit = True
+    
+    def generate(self, *args, **kwargs):
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            # Do not keep the last batch's gathered cross-attention cache alive
+            self._active_state = None
+    
+    def forward(self, *args, **kwargs):
+        decoder_input_ids = kwargs.get('decoder_input_ids')
+        encoder_outputs = kwargs.get('encoder_outputs')
+        past_key_values = kwargs.get('past_key_values')
+        
+        if (not self.early_exit or args or self.training or decoder_input_ids is None
+                or encoder_outputs is None or past_key_values is None):
+            return super().forward(*args, **kwargs)
+        
+        # Each tuple layer holds self-attention key/value, then cross-attention key/value.
+        # Newer transformers keep the two in separate caches of an EncoderDecoderCache.
+        legacy = isinstance(past_key_values, tuple)
+        if legacy:
+            self_past = tuple(layer[:2] for layer in past_key_values)
+        elif hasattr(past_key_values, 'cross_attention_cache'):
+            self_past = past_key_values.self_attention_cache.to_legacy_cache()
+        else:
+            return super().forward(**kwargs)
+        
+        # The first step has an empty cache and starts from decoder_start, which may equal eos
+        if len(self_past) == 0 or self_past[0][0].shape[-2] == 0:
+            return super().forward(**kwargs)
+        
+        pad_token_id = self.config.decoder.pad_token_id
+        eos_token_id = self.config.decoder.eos_token_id
+        last_tokens = decoder_input_ids[:, -1]
+        active = (last_tokens != pad_token_id) & (last_tokens != eos_token_id)
+        if active.all() or not active.any():
+            return super().forward(**kwargs)
+        
+        # Run the decoder on active rows only
+        batch_size = decoder_input_ids.shape[0]
+        rows = active.nonzero(as_tuple=True)[0]
+        active_cross, active_hidden_states = self._active_fixed_inputs(
+            rows, past_key_values, encoder_outputs[0]
+        )
+        active_self = tuple(tuple(cache[rows] for cache in layer) for layer in self_past)
+        if legacy:
+            active_past = tuple(layer + cross for layer, cross in zip(active_self, active_cross))
+        else:
+            self_cache_class = type(past_key_values.self_attention_cache)
+            active_past = type(past_key_values)(
+                self_cache_class.from_legacy_cache(active_self), active_cross
+            )
+        
+        kwargs['decoder_input_ids'] = decoder_input_ids[rows]
+        kwargs['encoder_outputs'] = BaseModelOutput(last_hidden_state=active_hidden_states)
+        kwargs['past_key_values'] = active_past
+        if kwargs.get('decoder_attention_mask') is not None:
+            kwargs['decoder_attention_mask'] = kwargs['decoder_attention_mask'][rows]
+        
+        outputs = super().forward(**kwargs)
+        
+        # Scatter back to the full batch, forcing pad on finished rows
+        logits = outputs.logits.new_full(
+            (batch_size,) + outputs.logits.shape[1:], float('-inf')
+        )
+        logits[..., pad_token_id] = 0
+        logits[rows] = outputs.logits
+        outputs.logits = logits
+        
+        if outputs.past_key_values is not None:
+            new_past = outputs.past_key_values
+            if legacy:
+                new_self = tuple(layer[:2] for layer in new_past)
+            else:
+                new_self = new_past.self_attention_cache.to_legacy_cache()
+            full_self = tuple(
+                tuple(self._scatter_rows(cache, rows, batch_size) for cache in layer)
+                for layer in new_self
+            )
+            
+            # Cross-attention entries never change, so the full-batch ones are passed on as is
+            if legacy:
+                outputs.past_key_values = tuple(
+                    layer + old_layer[2:] for layer, old_layer in zip(full_self, past_key_values)
+                )
+            else:
+                outputs.past_key_values = type(past_key_values)(
+                    self_cache_class.from_legacy_cache(full_self),
+                    past_key_values.cross_attention_cache
+                )
+        
+        return outputs
+    
+    def _active_fixed_inputs(self, rows, past_key_values, encoder_hidden_states):
+        """Active rows of the cross-attention cache and encoder states, gathered once per active set"""
+        legacy = isinstance(past_key_values, tuple)
+        # The same full-batch cross cache is passed in every step of one generate call
+        cross_source = past_key_values[0][2] if legacy else past_key_values.cross_attention_cache
+        
+        state = getattr(self, '_active_state', None)
+        if (state is None or state[1] is not cross_source or state[2] is not encoder_hidden_states
+                or not torch.equal(state[0], rows)):
+            if legacy:
+                active_cross = tuple(
+                    tuple(cache[rows] for cache in layer[2:]) for layer in past_key_values
+                )
+            else:
+                cross_cache = past_key_values.cross_attention_cache
+                active_cross = type(cross_cache).from_legacy_cache(tuple(
+                    tuple(cache[rows] for cache in layer) for layer in cross_cache.to_legacy_cache()
+                ))
+            state = (rows, cross_source, encoder_hidden_states,
+                     active_cross, encoder_hidden_states[rows])
+            self._active_state = state
+        
+        return state[3], state[4]
+    
+    @staticmethod
+    def _scatter_rows(cache, rows, batch_size):
+        """Expand a cache tensor computed on active rows back to the full batch"""
+        # Finished rows never attend again, so their slots can stay empty
+        full = cache.new_zeros((batch_size,) + cache.shape[1:])
+        full[rows] = cache
+        return full
+
 class MedicalImageAnalyzer:
-    def __init__(self):
-        self.supported_formats = ['.dcm', '.jpg', '.jpeg', '.png', '.tiff']
+    # Keywords that start each report section, one compiled pattern per section
+    SECTION_PATTERNS = {
+        'Patient Information': re.compile(r'patient|name:|age:|dob:|sex:'),
+        'Diagnosis': re.compile(r'diagnosis:|assessment:|condition:'),
+        'Findings': re.compile(r'finding|observation|shows|reveals'),
+        'Recommendations': re.compile(r'recommend|advise|follow|plan:')
+    }
+    
+    def __init__(self, use_onnx=True):
+        self.supported_formats = SUPPORTED_FORMATS
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # Initialize OCR model for text recognition
-        self.processor = TrOCRProcessor.from_pretrained('microsoft/trocr-base-handwritten')
-        self.model = VisionEncoderDecoderModel.from_pretrained('microsoft/trocr-base-handwritten')
-        if torch.cuda.is_available():
-            self.model.to('cuda')
+        self.processor = TrOCRProcessor.from_pretrained(TROCR_MODEL_NAME)
+        self.model = None
+        provider = self._onnx_provider() if use_onnx else None
+        if provider is not None:
+            try:
+                self.model = self._load_onnx_model(provider)
+            except Exception as e:
+                logger.warning(f"ONNX Runtime model unavailable, using PyTorch: {str(e)}")
+        
+        self.use_onnx = self.model is not None
+        if self.use_onnx:
+            self.dtype = torch.float32
+        else:
+            self.model = self._load_torch_model()
+            self.model.eval()
+            
+            # Run in half precision on GPU, where it halves weight bandwidth
+            self.dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
+            self.model.to(self.device, dtype=self.dtype)
+        
+        # Set the special tokens explicitly so generate does not have to infer them
+        decoder_config = self.model.config.decoder
+        generation_config = self.model.generation_config
+        generation_config.decoder_start_token_id = decoder_config.decoder_start_token_id
+        generation_config.pad_token_id = decoder_config.pad_token_id
+        generation_config.eos_token_id = decoder_config.eos_token_id
+        generation_config.forced_eos_token_id = decoder_config.eos_token_id
+        
+        # Normalization constants for images that are prepared on the GPU
+        image_processor = self.processor.image_processor
+        self.pixel_mean = torch.tensor(image_processor.image_mean, device=self.device).view(3, 1, 1)
+        self.pixel_std = torch.tensor(image_processor.image_std, device=self.device).view(3, 1, 1)
+    
+    def _onnx_provider(self):
+        """Get the ONNX Runtime provider for this device, or None if it is not installed"""
+        if ORTModelForVision2Seq is None:
+            return None
+        
+        # The CPU-only onnxruntime package has no CUDA provider; PyTorch is used on GPU then
+        provider = 'CUDAExecutionProvider' if self.device.type == 'cuda' else 'CPUExecutionProvider'
+        if provider not in onnxruntime.get_available_providers():
+            logger.info(f"{provider} not available in onnxruntime, using PyTorch")
+            return None
+        return provider
+    
+    def _load_onnx_model(self, provider):
+        """Load TrOCR on ONNX Runtime with the merged cache decoder, exporting it on first use"""
+        if not os.path.isdir(ONNX_MODEL_DIR):
+            self._export_onnx_model()
+        
+        return ORTModelForVision2Seq.from_pretrained(
+            ONNX_MODEL_DIR,
+            use_merged=True,
+            provider=provider,
+            # IO binding keeps inputs and the decoder cache on the GPU between steps
+            use_io_binding=provider == 'CUDAExecutionProvider'
+        )
+    
+    def _export_onnx_model(self):
+        """Export TrOCR to ONNX_MODEL_DIR, never leaving a partial export in its place"""
+        parent_dir = os.path.dirname(ONNX_MODEL_DIR)
+        os.makedirs(parent_dir, exist_ok=True)
+        
+        # Export into a temporary directory and rename it into place when complete
+        export_dir = tempfile.mkdtemp(prefix='trocr-onnx-', dir=parent_dir)
+        try:
+            model = ORTModelForVision2Seq.from_pretrained(TROCR_MODEL_NAME, export=True, use_merged=True)
+            model.save_pretrained(export_dir)
+            try:
+                os.rename(export_dir, ONNX_MODEL_DIR)
+            except OSError:
+                # Another process may have finished its export first
+                if not os.path.isdir(ONNX_MODEL_DIR):
+                    raise
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+    
+    def _load_torch_model(self):
+        """Load TrOCR in PyTorch, with fused SDPA attention in the ViT encoder where supported"""
+        try:
+            # Only the encoder is asked for SDPA, so a decoder without SDPA support
+            # does not force default attention on the encoder as well
+            model = EarlyExitVisionEncoderDecoderModel.from_pretrained(
+                TROCR_MODEL_NAME, attn_implementation={"encoder": "sdpa", "decoder": "eager"}
+            )
+        except (ValueError, TypeError, ImportError) as e:
+            # Older transformers releases cannot set attention per sub-model
+            logger.info(f"SDPA attention not available, using default attention: {str(e)}")
+            model = EarlyExitVisionEncoderDecoderModel.from_pretrained(TROCR_MODEL_NAME)
+        
+        encoder_attention = getattr(model.config.encoder, '_attn_implementation', 'eager')
+        decoder_attention = getattr(model.config.decoder, '_attn_implementation', 'eager')
+        logger.info(f"TrOCR attention: encoder {encoder_attention}, decoder {decoder_attention}")
+        return model
     
     def load_image(self, image_path):
         """Load medical image from various formats including DICOM"""
         try:
-            ext = os.path.splitext(image_path)[1].lower()
-            if ext not in self.supported_formats:
-                raise ValueError(f"Unsupported file format: {ext}")
+            if self._loads_to_gpu(image_path):
+                pixels = self._load_dicom_gpu(image_path)
+                if pixels is not None:
+                    return pixels
             
-            if ext == '.dcm':
-                return self._load_dicom(image_path)
-            else:
-                return Image.open(image_path)
+            return read_image(image_path)
         except Exception as e:
             logger.error(f"Error loading image: {str(e)}")
             raise
     
-    def _load_dicom(self, path):
-        """Load DICOM image"""
-        try:
-            dcm = pydicom.dcmread(path)
-            return Image.fromarray(dcm.pixel_array)
-        except Exception as e:
-            logger.error(f"Error loading DICOM: {str(e)}")
-            raise
+    def _loads_to_gpu(self, image_path):
+        """Check whether a file may be read straight into GPU memory"""
+        return (kvikio is not None and self.device.type == 'cuda'
+                and os.path.splitext(image_path)[1].lower() == '.dcm')
+    
+    def _load_dicom_gpu(self, path):
+        """Read uncompressed DICOM pixel data straight into GPU memory
+        
+        Returns the first frame as a float32 CUDA tensor, or None when the file
+        needs decoding on the CPU (compressed, big endian or multi-channel data).
+        """
+        dcm = pydicom.dcmread(path, defer_size="100 KB", stop_before_pixels=False)
+        transfer_syntax = dcm.file_meta.TransferSyntaxUID
+        if (transfer_syntax.is_compressed or not transfer_syntax.is_little_endian
+                or dcm.get('SamplesPerPixel', 1) != 1 or dcm.BitsAllocated not in (8, 16, 32)):
+            return None
+        
+        rows, columns = dcm.Rows, dcm.Columns
+        frames = int(dcm.get('NumberOfFrames', 1))
+        dtype = np.dtype(f"{'i' if dcm.PixelRepresentation else 'u'}{dcm.BitsAllocated // 8}")
+        n_bytes = rows * columns * frames * dtype.itemsize
+        offset = dcm.get_item(0x7FE00010, keep_deferred=True).value_tell
+        
+        buffer = cp.empty(n_bytes, dtype=cp.int8)
+        with kvikio.CuFile(path, "r") as f:
+            f.read(buffer, n_bytes, offset)
+        
+        pixels = buffer.view(dtype).reshape(frames, rows, columns)[0]
+        return torch.as_tensor(pixels.astype(cp.float32), device=self.device)
     
     def analyze_medical_report(self, image_path):
         """Analyze medical report image and extract information"""
@@ -52,26 +391,196 @@ class MedicalImageAnalyzer:
             # Load and preprocess image
             image = self.load_image(image_path)
             
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            return self.analyze_images([image])[0]
             
-            # Perform OCR on the image
-            pixel_values = self.processor(image, return_tensors="pt").pixel_values
-            if torch.cuda.is_available():
-                pixel_values = pixel_values.to('cuda')
-            
-            generated_ids = self.model.generate(pixel_values)
-            generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-            
-            # Process and structure the extracted text
-            analysis_result = self._process_medical_text(generated_text)
+        except Exception as e:
+            logger.error(f"Analysis failed: {str(e)}\n{traceback.format_exc()}")
+            raise
+    
+    def analyze_medical_reports(self, image_paths, cache=None, batch_size=8, num_workers=4):
+        """Analyze many report images, loading the next batch while the model runs
+        
+        Returns one entry per path: the analysis text, or the exception raised for
+        that image, so one bad file does not fail the others. When a cache (a
+        StaticProcessor) is given, images seen before are served from it.
+        """
+        reports = [None] * len(image_paths)
+        
+        # DICOMs read straight to the GPU are loaded here, since CUDA cannot be
+        # used from DataLoader workers
+        gpu_indices = [index for index, path in enumerate(image_paths) if self._loads_to_gpu(path)]
+        for start in range(0, len(gpu_indices), batch_size):
+            images = {}
+            for index in gpu_indices[start:start + batch_size]:
+                try:
+                    images[index] = self.prepare_image(self.load_image(image_paths[index]))
+                except Exception as e:
+                    reports[index] = e
             
-            return analysis_result
+            if images:
+                self._analyze_loaded(list(images), list(images.values()), None, reports, cache)
+        
+        # Workers decode and resize on the CPU; pinned batches copy to the GPU asynchronously.
+        # A single batch has nothing to overlap with, so it is loaded in this process
+        # rather than forking workers from one that holds the model and CUDA context.
+        gpu_index_set = set(gpu_indices)
+        cpu_indices = [index for index in range(len(image_paths)) if index not in gpu_index_set]
+        if cpu_indices:
+            loader = DataLoader(
+                ReportImageDataset([image_paths[index] for index in cpu_indices], self.processor),
+                batch_size=batch_size,
+                num_workers=num_workers if len(cpu_indices) > batch_size else 0,
+                pin_memory=self.device.type == 'cuda',
+                collate_fn=collate_reports
+            )
             
+            for positions, images, pixel_values, errors in loader:
+                for position, error in errors.items():
+                    reports[cpu_indices[position]] = error
+                if images:
+                    indices = [cpu_indices[position] for position in positions]
+                    self._analyze_loaded(indices, images, pixel_values, reports, cache)
+        
+        return reports
+    
+    def _analyze_loaded(self, indices, images, pixel_values, reports, cache):
+        """Analyze one loaded batch into reports, recording a failure on every unfinished entry"""
+        try:
+            if pixel_values is None:
+                pixel_values = self._to_pixel_values(images)
+            else:
+                pixel_values = pixel_values.to(self.device, dtype=self.dtype, non_blocking=True)
+            self._analyze_batch(indices, images, pixel_values, reports, cache)
         except Exception as e:
             logger.error(f"Analysis failed: {str(e)}\n{traceback.format_exc()}")
-            raise
+            for index in indices:
+                if reports[index] is None:
+                    reports[index] = e
+    
+    def prepare_image(self, image):
+        """Convert to RGB and downscale to the TrOCR input size while still uint8
+        
+        Already prepared images are returned unchanged, so this is safe to call twice.
+        """
+        if torch.is_tensor(image):
+            # GPU-loaded frames are 2-D; prepared ones are normalized 3x384x384 tensors
+            return self._prepare_tensor(image) if image.dim() == 2 else image
+        return resize_for_trocr(image)
+    
+    def _prepare_tensor(self, pixels):
+        """Resize and normalize a GPU-loaded grayscale frame without leaving the device"""
+        # Clip to the 8-bit range, as PIL does when converting the CPU-loaded frame
+        pixels = pixels.clamp(0, 255).div_(255)
+        # Antialias like PIL's BILINEAR downscale on the CPU path
+        pixels = F.interpolate(pixels[None, None], size=TROCR_IMAGE_SIZE[::-1],
+                               mode='bilinear', align_corners=False, antialias=True)[0]
+        return (pixels.expand(3, -1, -1) - self.pixel_mean) / self.pixel_std
+    
+    def analyze_images(self, images):
+        """Run OCR on a batch of loaded images with a single generate call"""
+        images = [self.prepare_image(image) for image in images]
+        
+        # Perform OCR on the whole batch at once
+        reports = [None] * len(images)
+        self._analyze_batch(range(len(images)), images, self._to_pixel_values(images), reports)
+        return reports
+    
+    def _analyze_batch(self, indices, images, pixel_values, reports, cache=None):
+        """OCR a prepared batch into reports[indices], serving images already in the cache"""
+        pending = []
+        for position, (index, image) in enumerate(zip(indices, images)):
+            # Images loaded straight to the GPU have no host bytes to hash
+            if cache is not None and not torch.is_tensor(image):
+                cached = cache.get_cached_result(cache.get_file_hash(image))
+                if cached:
+                    reports[index] = cached['results']
+                    continue
+            pending.append(position)
+        
+        if not pending:
+            return
+        
+        if len(pending) < len(images):
+            pixel_values = pixel_values[torch.tensor(pending, device=pixel_values.device)]
+        generated_texts = self._generate_text(pixel_values)
+        
+        # Process and structure the extracted text
+        for position, text in zip(pending, generated_texts):
+            report = self._process_medical_text(text)
+            reports[indices[position]] = report
+            if cache is not None and not torch.is_tensor(images[position]):
+                cache.cache_result(images[position], report)
+    
+    def _to_pixel_values(self, images):
+        """Stack prepared images into one normalized batch on the model device"""
+        pil_images = [image for image in images if not torch.is_tensor(image)]
+        pil_values = iter(())
+        if pil_images:
+            pil_values = self.processor(pil_images, return_tensors="pt", do_resize=False).pixel_values
+            pil_values = iter(pil_values.to(self.device, non_blocking=True))
+        
+        # GPU-loaded images are already normalized tensors; keep the batch order
+        pixel_values = torch.stack([
+            image if torch.is_tensor(image) else next(pil_values) for image in images
+        ])
+        return pixel_values.to(dtype=self.dtype)
+    
+    def check_early_exit(self, image_paths):
+        """Compare early-exit decoding with stock generate on one batch of images
+        
+        Returns whether the generated token ids match, and the seconds each took.
+        The batch should mix short and long reports, or no row finishes early.
+        """
+        if self.use_onnx:
+            raise ValueError("Early exit only applies to the PyTorch model")
+        
+        images = [self.prepare_image(self.load_image(image_path)) for image_path in image_paths]
+        pixel_values = self._to_pixel_values(images)
+        self._generate_ids(pixel_values)  # warm up kernels before timing
+        
+        generated, timings = [], []
+        try:
+            for early_exit in (True, False):
+                self.model.early_exit = early_exit
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                generated.append(self._generate_ids(pixel_values))
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                timings.append(time.perf_counter() - start)
+        finally:
+            self.model.early_exit = True
+        
+        lengths = (generated[1] != self.model.generation_config.pad_token_id).sum(dim=1)
+        if lengths.min() == lengths.max():
+            logger.warning("All reports decoded to the same length, so no rows exited early")
+        
+        return torch.equal(*generated), timings[0], timings[1]
+    
+    def _generate_text(self, pixel_values):
+        """Decode text from pixel values, running the encoder only once"""
+        return self.processor.batch_decode(self._generate_ids(pixel_values), skip_special_tokens=True)
+    
+    def _generate_ids(self, pixel_values):
+        """Greedily generate token ids for a batch of pixel values"""
+        with torch.no_grad():
+            if self.use_onnx:
+                inputs = {'pixel_values': pixel_values}
+            else:
+                # Encode up front so generate reuses the output for every decoding step
+                inputs = {'encoder_outputs': self.model.encoder(pixel_values=pixel_values)}
+            
+            # Greedy decoding, the TrOCR default for line transcription
+            generated_ids = self.model.generate(
+                **inputs,
+                use_cache=True,
+                max_new_tokens=96,
+                num_beams=1,
+                do_sample=False
+            )
+        
+        return generated_ids
     
     def _process_medical_text(self, text):
         """Process and structure the extracted medical text"""
@@ -94,14 +603,10 @@ class MedicalImageAnalyzer:
                 
             # Classify line into sections based on keywords
             lower_line = line.lower()
-            if any(keyword in lower_line for keyword in ['patient', 'name:', 'age:', 'dob:', 'sex:']):
-                current_section = 'Patient Information'
-            elif any(keyword in lower_line for keyword in ['diagnosis:', 'assessment:', 'condition:']):
-                current_section = 'Diagnosis'
-            elif any(keyword in lower_line for keyword in ['finding', 'observation', 'shows', 'reveals']):
-                current_section = 'Findings'
-            elif any(keyword in lower_line for keyword in ['recommend', 'advise', 'follow', 'plan:']):
-                current_section = 'Recommendations'
+            for section, pattern in self.SECTION_PATTERNS.items():
+                if pattern.search(lower_line):
+                    current_section = section
+                    break
             
             sections[current_section].append(line)
         
@@ -116,10 +621,21 @@ class MedicalImageAnalyzer:
         return result
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python analyze_image.py <path_to_image>")
+    if len(sys.argv) < 2:
+        print("Usage: python analyze_image.py [--check-early-exit] <path_to_image> [<path_to_image> ...]")
         sys.exit(1)
+    
+    if sys.argv[1] == '--check-early-exit':
+        # Greedy output must be identical with and without skipping finished rows
+        analyzer = MedicalImageAnalyzer(use_onnx=False)
+        matches, early_exit_time, stock_time = analyzer.check_early_exit(sys.argv[2:])
+        print(f"Outputs match: {matches}")
+        print(f"Early exit: {early_exit_time:.3f}s, stock generate: {stock_time:.3f}s")
+        sys.exit(0 if matches else 1)
         
     analyzer = MedicalImageAnalyzer()
-    result = analyzer.analyze_medical_report(sys.argv[1])
-    print(result)
+    for image_path, result in zip(sys.argv[1:], analyzer.analyze_medical_reports(sys.argv[1:])):
+        if isinstance(result, Exception):
+            print(f"{image_path}: Error: {str(result)}")
+        else:
+            print(result)
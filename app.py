@@ -10,103 +10,50 @@ import traceback
 import base64
 from io import BytesIO
 import threading
-import queue
+from array import array
 import uuid
 from functools import lru_cache
-import torch
 import time
+import gevent
+import redis
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 from gevent.pywsgi import WSGIServer
 from gevent.pool import Pool
 
-from analyze_image import MedicalImageAnalyzer
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class JobQueue:
-    def __init__(self, max_size=50):
-        self.queue = queue.Queue(maxsize=max_size)
-        self.results = {}
-        self.processing = set()
-        self._stop = False
-        self.worker_thread = threading.Thread(target=self._process_queue)
-        self.worker_thread.daemon = True
-        self.worker_thread.start()
-    
-    def add_job(self, job_id, image_path):
-        """Add a job to the queue"""
-        try:
-            self.queue.put((job_id, image_path), block=False)
-            return True
-        except queue.Full:
-            return False
-    
-    def get_result(self, job_id):
-        """Get job result"""
-        if job_id in self.results:
-            return self.results.pop(job_id)
-        if job_id in self.processing:
-            return {'status': 'processing'}
-        return {'status': 'not_found'}
-    
-    def _process_queue(self):
-        """Process jobs in the queue"""
-        analyzer = MedicalImageAnalyzer()
-        
-        while not self._stop:
-            try:
-                job_id, image_path = self.queue.get(timeout=1)
-                self.processing.add(job_id)
-                
-                try:
-                    # Process image
-                    results = analyzer.analyze_medical_report(image_path)
-                    
-                    self.results[job_id] = {
-                        'status': 'completed',
-                        'results': results
-                    }
-                except Exception as e:
-                    self.results[job_id] = {
-                        'status': 'error',
-                        'error': str(e)
-                    }
-                finally:
-                    self.processing.remove(job_id)
-                    if os.path.exists(image_path):
-                        try:
-                            os.remove(image_path)
-                        except:
-                            pass
-                    
-            except queue.Empty:
-                continue
-            except Exception as e:
-                logger.error(f"Error processing queue: {str(e)}")
-
 class RateLimiter:
+    LOCK_STRIPES = 32
+    
     def __init__(self, max_requests=20, time_window=60):
         self.max_requests = max_requests
         self.time_window = time_window
+        # Per client, a fixed ring of the last max_requests admitted timestamps
+        # and the index of the oldest one, kept in parallel dicts
         self.requests = {}
-        self.lock = threading.Lock()
+        self.heads = {}
+        # Striped locks so different clients rarely contend on the same lock
+        self.locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
     
     def is_allowed(self, client_id):
-        with self.lock:
+        with self.locks[hash(client_id) % self.LOCK_STRIPES]:
             now = time.time()
-            if client_id not in self.requests:
-                self.requests[client_id] = []
+            timestamps = self.requests.get(client_id)
+            if timestamps is None:
+                timestamps = self.requests[client_id] = array('d', [float('-inf')]) * self.max_requests
+            head = self.heads.get(client_id, 0)
             
-            # Remove old requests
-            self.requests[client_id] = [t for t in self.requests[client_id] 
-                                      if now - t < self.time_window]
+            # Under limit only if the oldest of the last max_requests has left the window
+            if now - timestamps[head] < self.time_window:
+                return False
             
-            # Check if under limit
-            if len(self.requests[client_id]) < self.max_requests:
-                self.requests[client_id].append(now)
-                return True
-            return False
+            timestamps[head] = now
+            self.heads[client_id] = (head + 1) % self.max_requests
+            return True
 
 # Initialize Flask app
 app = Flask(__name__, 
@@ -121,8 +68,13 @@ if not os.path.exists(UPLOAD_FOLDER):
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Jobs are processed by worker.py, which keeps the model loaded in its own process
+MAX_QUEUED_JOBS = 50
+JOB_TTL = 3600  # keep results and failures for an hour
+redis_conn = redis.Redis(host='localhost', port=6379, db=0)
+analysis_queue = Queue('medical_analysis', connection=redis_conn)
+
 # Initialize components
-job_queue = JobQueue(max_size=50)
 rate_limiter = RateLimiter(max_requests=20, time_window=60)
 
 @app.route('/')
@@ -152,12 +104,13 @@ def analyze():
             file.save(file_path)
             
             # Add job to queue
-            job_id = str(uuid.uuid4())
-            if job_queue.add_job(job_id, file_path):
-                return jsonify({'job_id': job_id})
-            else:
+            if len(analysis_queue) >= MAX_QUEUED_JOBS:
                 os.remove(file_path)
                 return jsonify({'error': 'Server is busy'}), 503
+            
+            job = analysis_queue.enqueue('worker.process_image', file_path,
+                                         result_ttl=JOB_TTL, failure_ttl=JOB_TTL)
+            return jsonify({'job_id': job.id})
     
     except Exception as e:
         logger.error(f"Error processing upload: {str(e)}")
@@ -166,32 +119,45 @@ def analyze():
 @app.route('/status/<job_id>')
 def get_job_status(job_id):
     try:
-        result = job_queue.get_result(job_id)
-        return jsonify(result)
+        try:
+            job = Job.fetch(job_id, connection=redis_conn)
+        except NoSuchJobError:
+            return jsonify({'status': 'not_found'})
+        
+        status = job.get_status()
+        if status == JobStatus.FINISHED:
+            return jsonify({'status': 'completed', 'results': job.result})
+        if status == JobStatus.FAILED:
+            # Report the exception line of the worker traceback
+            error = (job.exc_info or 'Unknown error').strip().splitlines()[-1]
+            return jsonify({'status': 'error', 'error': error})
+        return jsonify({'status': 'processing'})
     except Exception as e:
         logger.error(f"Error getting job status: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+CLEANUP_INTERVAL = 3600  # seconds between upload directory cleanups
+
 def cleanup_old_files():
-    """Clean up old files in upload directory"""
+    """Clean up old files in upload directory, then schedule the next run"""
     try:
         current_time = time.time()
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.getctime(file_path) < current_time - 3600:  # 1 hour old
-                os.remove(file_path)
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                if entry.stat().st_ctime < current_time - 3600:  # 1 hour old
+                    os.remove(entry.path)
     except Exception as e:
         logger.error(f"Error cleaning up files: {str(e)}")
+    finally:
+        gevent.spawn_later(CLEANUP_INTERVAL, cleanup_old_files)
 
 if __name__ == '__main__':
     # Enable CORS for development
     from flask_cors import CORS
     CORS(app)
     
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_old_files)
-    cleanup_thread.daemon = True
-    cleanup_thread.start()
+    # Start periodic cleanup
+    gevent.spawn(cleanup_old_files)
     
     # Start server
     http_server = WSGIServer(('0.0.0.0', 5000), app)
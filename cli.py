@@ -18,13 +18,16 @@ def analyze_image(image):
         image = image.convert('L')
     
     # Get image array
-    img_array = np.array(image)
+    img_array = np.asarray(image, dtype=np.uint8)
     
-    # Calculate basic statistics
-    mean = np.mean(img_array)
-    std = np.std(img_array)
-    min_val = np.min(img_array)
-    max_val = np.max(img_array)
+    # Calculate basic statistics from a single histogram pass
+    histogram = np.bincount(img_array.ravel(), minlength=256)
+    levels = np.arange(256, dtype=np.float64)
+    mean = histogram @ levels / img_array.size
+    std = np.sqrt(max(histogram @ (levels * levels) / img_array.size - mean ** 2, 0.0))
+    present = np.flatnonzero(histogram)
+    min_val = int(present[0])
+    max_val = int(present[-1])
     
     # Simple contrast measure
     contrast = (max_val - min_val) / (max_val + min_val + 1e-6)
@@ -1,6 +1,6 @@
 import cv2
 import numpy as np
-from PIL import Image, ImageEnhance
+from PIL import Image
 import io
 import logging
 
@@ -11,10 +11,20 @@ logger = logging.getLogger(__name__)
 class ImageProcessor:
     def __init__(self):
         self.target_size = (224, 224)  # Standard size for many deep learning models
+        self.contrast = 1.2  # Slight contrast enhancement
+        self.sharpness = 1.1  # Slight sharpness enhancement
+        
+        # Sharpness blends the image with PIL's 3x3 SMOOTH filter, and contrast is a
+        # linear scale, so both enhancements fold into a single convolution kernel
+        smooth = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+        identity = np.zeros((3, 3), dtype=np.float32)
+        identity[1, 1] = 1
+        sharpen = self.sharpness * identity + (1 - self.sharpness) * smooth
+        self.enhance_kernel = self.contrast * sharpen
         logger.info("Initializing Image Processor")
     
     def process_image(self, image_path):
-        """Process the image for analysis"""
+        """Process the image for analysis, returning an RGB uint8 array"""
         try:
             # Open image
             if isinstance(image_path, str):
@@ -26,25 +36,31 @@ class ImageProcessor:
             if image.mode != 'RGB':
                 image = image.convert('RGB')
             
-            # Enhance image
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(1.2)  # Slight contrast enhancement
+            arr = np.asarray(image)
             
-            enhancer = ImageEnhance.Sharpness(image)
-            image = enhancer.enhance(1.1)  # Slight sharpness enhancement
+            # Enhance contrast and sharpness in one pass; contrast pulls pixels
+            # away from the mean luminance, like ImageEnhance.Contrast
+            r, g, b = cv2.mean(arr)[:3]
+            mean = int(0.299 * r + 0.587 * g + 0.114 * b + 0.5)
+            arr = cv2.filter2D(arr, -1, self.enhance_kernel,
+                               delta=(1 - self.contrast) * mean,
+                               borderType=cv2.BORDER_REPLICATE)
             
-            # Resize image while maintaining aspect ratio
-            image.thumbnail(self.target_size, Image.Resampling.LANCZOS)
+            # Resize image while maintaining aspect ratio (downscale only, like thumbnail)
+            height, width = arr.shape[:2]
+            scale = min(self.target_size[0] / width, self.target_size[1] / height, 1.0)
+            if scale < 1.0:
+                new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                arr = cv2.resize(arr, new_size, interpolation=cv2.INTER_AREA)
+                height, width = arr.shape[:2]
             
-            # Create new image with padding to get exact target size
-            new_image = Image.new('RGB', self.target_size, (0, 0, 0))
-            
-            # Paste the resized image in the center
-            offset = ((self.target_size[0] - image.size[0]) // 2,
-                     (self.target_size[1] - image.size[1]) // 2)
-            new_image.paste(image, offset)
-            
-            return new_image
+            # Pad with black to get exact target size, keeping the image centered.
+            # The padded array is returned as is; converting to PIL would copy it again.
+            left = (self.target_size[0] - width) // 2
+            top = (self.target_size[1] - height) // 2
+            return cv2.copyMakeBorder(arr, top, self.target_size[1] - height - top,
+                                      left, self.target_size[0] - width - left,
+                                      cv2.BORDER_CONSTANT, value=(0, 0, 0))
             
         except Exception as e:
             logger.error(f"Error processing image: {str(e)}")
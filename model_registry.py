@@ -0,0 +1,16 @@
+from functools import lru_cache
+from analyze_image import MedicalImageAnalyzer as OCRAnalyzer
+from ai_models import MedicalImageAnalyzer as ImageClassifier
+
+# Each analyzer holds hundreds of MB of weights, so every module in a process
+# shares a single instance, created on first use
+
+@lru_cache(maxsize=1)
+def get_ocr_analyzer():
+    """Get the shared TrOCR report analyzer"""
+    return OCRAnalyzer()
+
+@lru_cache(maxsize=1)
+def get_classifier():
+    """Get the shared ResNet image analyzer"""
+    return ImageClassifier()
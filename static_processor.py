@@ -1,12 +1,17 @@
 import os
-import json
+import orjson
 import shutil
+from pathlib import Path
+import cv2
+import numpy as np
 from PIL import Image
 import hashlib
+import heapq
+import time
 from datetime import datetime
 import threading
 from image_processor import ImageProcessor
-from ai_models import MedicalImageAnalyzer
+from model_registry import get_classifier
 
 class StaticProcessor:
     def __init__(self, static_dir='static/cache', max_cache_size_mb=1024):
@@ -22,12 +27,20 @@ class StaticProcessor:
         
         # Initialize processors
         self.image_processor = ImageProcessor()
-        self.ai_analyzer = MedicalImageAnalyzer()
         
-        # Start cleanup thread
-        self.cleanup_thread = threading.Thread(target=self._cleanup_old_files)
-        self.cleanup_thread.daemon = True
-        self.cleanup_thread.start()
+        # Track cached files in memory so eviction does not walk the directory on every
+        # write. Worker processes share static_dir, so the index is re-synced from disk
+        # periodically to pick up their writes and evictions.
+        self.index_sync_interval = 60  # seconds
+        self._cache_index = {}  # file path -> (size in bytes, last access time)
+        self._cache_size = 0
+        self._last_index_sync = 0
+        self._sync_cache_index()
+    
+    @property
+    def ai_analyzer(self):
+        """Shared image analyzer, loaded on first use"""
+        return get_classifier()
     
     def get_file_hash(self, image):
         """Generate hash for image file"""
@@ -49,12 +62,17 @@ class StaticProcessor:
             return None
             
         try:
-            with open(result_path, 'r') as f:
-                results = json.load(f)
+            results = orjson.loads(Path(result_path).read_bytes())
             
             # Update access time
             os.utime(result_path, None)
             os.utime(image_path, None)
+            with self.cache_lock:
+                now = time.time()
+                for filepath in (result_path, image_path):
+                    if filepath in self._cache_index:
+                        size, _ = self._cache_index[filepath]
+                        self._cache_index[filepath] = (size, now)
             
             return {
                 'results': results,
@@ -70,53 +88,73 @@ class StaticProcessor:
                 # Generate hash
                 file_hash = self.get_file_hash(image)
                 
-                # Save optimized image
+                # Save optimized image, skipping the cache entry if it cannot be encoded
                 image_path = os.path.join(self.images_dir, f"{file_hash}.jpg")
-                image.save(image_path, 'JPEG', quality=85, optimize=True)
+                arr = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+                encoded, image_bytes = cv2.imencode('.jpg', arr, [cv2.IMWRITE_JPEG_QUALITY, 85,
+                                                                  cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+                if not encoded:
+                    return None
+                Path(image_path).write_bytes(image_bytes)
                 
                 # Save results
                 result_path = os.path.join(self.results_dir, f"{file_hash}.json")
-                with open(result_path, 'w') as f:
-                    json.dump(results, f)
+                result_bytes = orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY)
+                Path(result_path).write_bytes(result_bytes)
+                
+                # Account for the new files and evict if the cache grew too large
+                now = time.time()
+                for filepath, size in ((image_path, len(image_bytes)), (result_path, len(result_bytes))):
+                    old_size, _ = self._cache_index.get(filepath, (0, 0))
+                    self._cache_index[filepath] = (size, now)
+                    self._cache_size += size - old_size
+                self._cleanup_old_files()
                 
                 return file_hash
         except:
             return None
     
+    def _sync_cache_index(self):
+        """Rebuild the in-memory cache index from every file under static_dir
+        
+        This includes files written or evicted by other processes, and files
+        left without their result or image. Must be called with cache_lock held.
+        """
+        index = {}
+        for root, _, filenames in os.walk(self.static_dir):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                index[filepath] = (stat.st_size, stat.st_atime)
+        
+        self._cache_index = index
+        self._cache_size = sum(size for size, _ in index.values())
+        self._last_index_sync = time.monotonic()
+    
     def _cleanup_old_files(self):
-        """Cleanup old cache files periodically"""
-        while True:
-            try:
-                total_size = 0
-                files = []
-                
-                # Get all cached files with their timestamps
-                for root, _, filenames in os.walk(self.static_dir):
-                    for filename in filenames:
-                        filepath = os.path.join(root, filename)
-                        size = os.path.getsize(filepath)
-                        accessed = os.path.getatime(filepath)
-                        files.append((filepath, size, accessed))
-                        total_size += size
-                
-                # If cache is too large, remove oldest files
-                if total_size > self.max_cache_size:
-                    # Sort by access time (oldest first)
-                    files.sort(key=lambda x: x[2])
-                    
-                    # Remove files until we're under the limit
-                    for filepath, size, _ in files:
-                        if total_size <= self.max_cache_size:
-                            break
-                            
-                        try:
-                            os.remove(filepath)
-                            total_size -= size
-                        except:
-                            continue
-            
-            except Exception as e:
-                print(f"Error in cleanup: {str(e)}")
+        """Evict least recently used cache files until under the size limit
+        
+        Must be called with cache_lock held.
+        """
+        if time.monotonic() - self._last_index_sync > self.index_sync_interval:
+            self._sync_cache_index()
+        
+        if self._cache_size <= self.max_cache_size:
+            return
+        
+        # Oldest access time first
+        entries = [(accessed, filepath) for filepath, (_, accessed) in self._cache_index.items()]
+        heapq.heapify(entries)
+        
+        while entries and self._cache_size > self.max_cache_size:
+            _, filepath = heapq.heappop(entries)
+            size, _ = self._cache_index.pop(filepath)
+            self._cache_size -= size
             
-            # Sleep for 1 hour before next cleanup
-            threading.Event().wait(3600)
+            try:
+                os.remove(filepath)
+            except:
+                continue
@@ -1,35 +1,115 @@
 import os
+import time
+import logging
 import redis
-from rq import Worker, Queue, Connection
-from image_processor import ImageProcessor
-from ai_models import MedicalImageAnalyzer
-import torch
+from rq import Queue, SimpleWorker
+from rq.timeouts import JobTimeoutException
+from functools import lru_cache
+from model_registry import get_ocr_analyzer
+from static_processor import StaticProcessor
+
+logger = logging.getLogger(__name__)
 
 # Configure Redis connection
 redis_conn = redis.Redis(host='localhost', port=6379, db=0)
 
-# Initialize processors
-image_processor = ImageProcessor()
-ai_analyzer = MedicalImageAnalyzer()
+# Reports computed by BatchWorker ahead of running each job, keyed by image path
+_batch_results = {}
+
+@lru_cache(maxsize=1)
+def get_static_processor():
+    """Create the result cache once per worker process"""
+    return StaticProcessor()
+
+def analyze_reports(image_paths):
+    """Analyze uploaded reports in one batch, serving repeated uploads from the cache
+    
+    Returns one entry per path: the analysis text, or the exception raised for
+    that image, so one bad upload does not fail the rest of the batch.
+    """
+    return get_ocr_analyzer().analyze_medical_reports(image_paths, cache=get_static_processor())
 
-def process_image(image_data):
-    """Process image with model"""
-    with torch.no_grad():
+def process_image(image_path):
+    """Analyze an uploaded report, using the batched result when one is ready"""
+    try:
+        if image_path in _batch_results:
+            report = _batch_results.pop(image_path)
+        else:
+            report = analyze_reports([image_path])[0]
+        
+        if isinstance(report, Exception):
+            raise report
+        return report
+    finally:
+        if os.path.exists(image_path):
+            try:
+                os.remove(image_path)
+            except:
+                pass
+
+class BatchWorker(SimpleWorker):
+    """SimpleWorker that runs queued analysis jobs through the model together
+    
+    When a job is picked up, more queued jobs are drained for a short window and
+    all their images are analyzed in one batch. Each job is then executed as
+    usual, so RQ records its status and result, and it returns its batched report.
+    If the batch fails, each job analyzes its own image instead.
+    """
+    max_batch_size = 8
+    batch_timeout = 0.05  # seconds to wait for more jobs to join a batch
+    
+    def execute_job(self, job, queue):
+        batch = [(job, queue)]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.max_batch_size and time.monotonic() < deadline:
+            next_job = self.queue_class.dequeue_any(self.queues, None,
+                                                    connection=self.connection,
+                                                    job_class=self.job_class,
+                                                    serializer=self.serializer)
+            if next_job is None:
+                time.sleep(0.005)
+                continue
+            batch.append(next_job)
+        
+        # Drained jobs are off the queue, so mark them started before the batch runs.
+        # If this process dies, RQ then fails them instead of losing them.
+        timeout = 0
+        for job, queue in batch:
+            job_timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+            queue.started_job_registry.add(job, job_timeout + 60)
+            timeout = max(timeout, job_timeout)
+        
+        image_paths = [job.args[0] for job, _ in batch if job.func_name == 'worker.process_image']
+        if image_paths:
+            self._analyze_batch(image_paths, timeout)
+        
+        for job, queue in batch:
+            super().execute_job(job, queue)
+    
+    def _analyze_batch(self, image_paths, timeout):
+        """Precompute reports for the batch under a job timeout, like RQ runs a job"""
+        self.heartbeat(timeout + 60)
         try:
-            # Preprocess image
-            processed = image_processor.preprocess_image(image_data)
-            
-            # Get predictions
-            results = ai_analyzer.analyze_image(processed)
-            insights = ai_analyzer.generate_insights(results)
-            
-            return results, insights
+            with self.death_penalty_class(timeout, JobTimeoutException):
+                _batch_results.update(zip(image_paths, analyze_reports(image_paths)))
         except Exception as e:
-            print(f"Error processing image: {str(e)}")
-            return None
+            # process_image falls back to analyzing each image on its own
+            logger.warning(f"Batch analysis failed, running jobs one at a time: {str(e)}")
+
+def main():
+    # Load the model (and run any ONNX export) before taking jobs,
+    # so it does not count against the first job's timeout
+    get_ocr_analyzer()
+    get_static_processor()
+    
+    # SimpleWorker runs jobs in this process instead of forking per job,
+    # so the model is loaded once and stays resident on the GPU
+    worker = BatchWorker([Queue('medical_analysis', connection=redis_conn)],
+                         connection=redis_conn)
+    worker.work()
 
 if __name__ == '__main__':
-    # Start worker
-    with Connection(redis_conn):
-        worker = Worker(Queue('medical_analysis'))
-        worker.work()
+    # Jobs run 'worker.process_image', so start from the importable module to
+    # share its preloaded state instead of a second copy under __main__
+    import worker
+    worker.main()